@@ -3,28 +3,109 @@ Agent Support Automation - Customer Portal API
 Handles API key management, usage stats, billing, and ticket creation.
 """
 
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import Optional, List
+from cachetools import LRUCache, TTLCache
+from typing import Optional, List, Dict, Tuple, NamedTuple
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
+import logging
 import sqlite3
+import queue
+import re
+import threading
 import secrets
 import hashlib
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timedelta, timezone
 import os
 
-app = FastAPI(title="Agent Support API", version="0.1.0")
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_pool()
+    init_db()
+    stop = asyncio.Event()
+    flusher = asyncio.create_task(flush_usage_periodically(stop))
+    try:
+        yield
+    finally:
+        # Let an in-flight flush finish (cancel() can't stop its worker thread)
+        stop.set()
+        try:
+            await flusher
+            flush_usage()
+        finally:
+            close_pool()
+
+# orjson encodes the list endpoints' payloads much faster than stdlib json
+app = FastAPI(
+    title="Agent Support API",
+    version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+# CORS for frontend (comma-separated FRONTEND_ORIGIN; defaults to the quickstart portal)
+FRONTEND_ORIGINS = os.getenv("FRONTEND_ORIGIN", "http://localhost:8000").split(",")
 
-# CORS for frontend
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Configure for production
+    allow_origins=[origin.strip() for origin in FRONTEND_ORIGINS],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "DELETE"],
+    allow_headers=["X-Customer-ID", "Content-Type"],
+    max_age=600,  # Browsers reuse the preflight result for 10 minutes
 )
 
 DATABASE = "support.db"
+DB_POOL_SIZE = 8
+
+# Per-connection settings; journal_mode=WAL is set once in init_db and
+# persists in the database file (readers no longer block the writer)
+DB_PRAGMAS = """
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-64000;
+    PRAGMA mmap_size=268435456;
+    PRAGMA foreign_keys=ON;
+"""
+
+DB_POOL: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+DB_WRITER: Optional[sqlite3.Connection] = None
+DB_WRITE_LOCK = threading.Lock()
+
+# Short-lived read caches for the dashboard endpoints (stats by customer_id,
+# stored with the UTC day they were computed for; billing by
+# (customer_id, before, limit) page)
+STATS_CACHE_TTL = 30
+BILLING_CACHE_TTL = 300
+_STATS_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=STATS_CACHE_TTL)
+_BILLING_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=BILLING_CACHE_TTL)
+_CACHE_LOCK = threading.Lock()
+
+# API key hash -> (customer_id, key_id, revoked). Writers pop the hashes they
+# touched and bump the generation while holding DB_WRITE_LOCK; a lookup that
+# raced with a write sees the new generation and doesn't store its result
+_KEY_CACHE: LRUCache = LRUCache(maxsize=4096)
+_KEY_CACHE_GENERATION = 0
+_KEY_CACHE_LOCK = threading.Lock()
+
+# Mock rate limiting (1000 requests/day for MVP). Today's count per customer
+# is kept in memory, seeded from the usage table the first time it is needed
+RATE_LIMIT = 1000
+_USAGE_COUNTERS: Dict[Tuple[str, str], int] = {}
+_COUNTER_LOCK = threading.Lock()
+
+# Tracked calls are buffered and written in batches (one transaction per flush)
+USAGE_FLUSH_INTERVAL = 0.2
+USAGE_BUFFER_MAX = 10_000
+_USAGE_BUFFER: List[Tuple] = []
+_BUFFER_LOCK = threading.Lock()
 
 # Models
 class APIKeyRequest(BaseModel):
@@ -52,6 +133,12 @@ class UsageStats(BaseModel):
     current_rate_limit: int
     rate_limit_reset: Optional[str]
 
+class UsageTrackRequest(BaseModel):
+    customer_id: str
+    api_key_hash: str
+    endpoint: Optional[str] = None
+    success: bool = True
+
 class BillingHistory(BaseModel):
     invoice_id: str
     date: str
@@ -59,9 +146,15 @@ class BillingHistory(BaseModel):
     status: str
     description: str
 
+class BillingPage(BaseModel):
+    invoices: List[BillingHistory]
+    next_cursor: Optional[str]
+
 # Database setup
 def init_db():
-    conn = sqlite3.connect(DATABASE)
+    """Create the schema on the writer connection (run once at startup)"""
+    conn = DB_WRITER
+    conn.execute("PRAGMA journal_mode=WAL")
     c = conn.cursor()
     
     # API keys table
@@ -129,16 +222,241 @@ def init_db():
         )
     ''')
     
+    # Indexes for the per-customer lookups the portal runs on every page
+    c.execute("CREATE INDEX IF NOT EXISTS idx_usage_cust_ts ON usage(customer_id, timestamp)")
+    # Tickets page by id (the index's implicit rowid column), not created_at
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tickets_cust ON tickets(customer_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_billing_cust_created ON billing(customer_id, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_api_keys_cust ON api_keys(customer_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_api_keys_hash_cov ON api_keys(key_hash, customer_id, revoked, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_responses_ticket ON ticket_responses(ticket_id, created_at)")
+    
     conn.commit()
-    conn.close()
 
-init_db()
+# Connection pool
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DATABASE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(DB_PRAGMAS)
+    return conn
+
+def init_pool():
+    """Open the shared reader pool and the single writer connection"""
+    global DB_WRITER
+    for _ in range(DB_POOL_SIZE):
+        DB_POOL.put(_connect())
+    DB_WRITER = _connect()
+
+def close_pool():
+    """Close every pooled connection (on shutdown)"""
+    global DB_WRITER
+    while not DB_POOL.empty():
+        DB_POOL.get_nowait().close()
+    with DB_WRITE_LOCK:
+        if DB_WRITER is not None:
+            DB_WRITER.close()
+            DB_WRITER = None
+
+@contextmanager
+def get_conn():
+    """Borrow a pooled connection for reads"""
+    conn = DB_POOL.get()
+    try:
+        yield conn
+    finally:
+        DB_POOL.put(conn)
+
+@contextmanager
+def get_write_conn():
+    """Borrow the writer connection; writes are serialized to avoid SQLITE_BUSY"""
+    with DB_WRITE_LOCK:
+        try:
+            yield DB_WRITER
+        except BaseException:
+            DB_WRITER.rollback()
+            raise
+
+# SQL statements (module constants so each connection's statement cache reuses them)
+# The planner prefers the UNIQUE(key_hash) index, which still needs a
+# table read; the covering index answers without touching the table
+SQL_LOOKUP_KEY_HASH = """SELECT customer_id, id, revoked
+                         FROM api_keys INDEXED BY idx_api_keys_hash_cov WHERE key_hash = ?"""
+SQL_INSERT_API_KEY = "INSERT INTO api_keys (customer_id, key_hash, name) VALUES (?, ?, ?)"
+SQL_REVOKE_KEY_BY_HASH = "UPDATE api_keys SET revoked = 1 WHERE customer_id = ? AND key_hash = ? AND revoked = 0"
+# List queries use keyset pagination: ids are AUTOINCREMENT, so newest-first
+# by id matches created_at order without ties between same-second rows.
+# Later pages get their own statement so the index can seek on the cursor
+SQL_LIST_API_KEYS = """SELECT id, name, created_at, last_used, revoked 
+                       FROM api_keys WHERE customer_id = ?
+                       ORDER BY id DESC LIMIT ?"""
+SQL_LIST_API_KEYS_BEFORE = """SELECT id, name, created_at, last_used, revoked 
+                              FROM api_keys WHERE customer_id = ? AND id < ?
+                              ORDER BY id DESC LIMIT ?"""
+SQL_COUNT_ACTIVE_KEYS = "SELECT COUNT(*) FROM api_keys WHERE customer_id = ? AND revoked = 0"
+# RETURNING (SQLite 3.35+) hands back the hash to invalidate from the same statement
+SQL_REVOKE_CUSTOMER_KEY = """UPDATE api_keys SET revoked = 1 WHERE id = ? AND customer_id = ?
+                             RETURNING key_hash"""
+# Today, this month and all time in a single scan. timestamp holds
+# CURRENT_TIMESTAMP text (UTC, 'YYYY-MM-DD HH:MM:SS'), which sorts
+# correctly against date(), so plain range checks replace DATE()/strftime()
+SQL_USAGE_STATS = """SELECT
+                         COALESCE(SUM(CASE WHEN timestamp >= date('now', 'start of day')
+                                            AND timestamp < date('now', 'start of day', '+1 day')
+                                           THEN 1 ELSE 0 END), 0),
+                         COALESCE(SUM(CASE WHEN timestamp >= date('now', 'start of month')
+                                            AND timestamp < date('now', 'start of month', '+1 month')
+                                           THEN 1 ELSE 0 END), 0),
+                         COUNT(*)
+                     FROM usage WHERE customer_id = ?"""
+SQL_USAGE_TODAY = """SELECT COUNT(*) FROM usage
+                     WHERE customer_id = ? AND timestamp >= date('now', 'start of day')
+                       AND timestamp < date('now', 'start of day', '+1 day')"""
+SQL_INSERT_USAGE = """INSERT INTO usage (customer_id, api_key_hash, endpoint, success, timestamp) 
+                      VALUES (?, ?, ?, ?, ?)"""
+# Invoice dates needn't follow insertion order, so billing pages on
+# (created_at, id): the id breaks ties between same-second invoices. Later
+# pages spell the row comparison out so the index can seek on created_at
+SQL_BILLING_HISTORY = """SELECT id, invoice_id, created_at, amount, status, description 
+                         FROM billing WHERE customer_id = ?
+                         ORDER BY created_at DESC, id DESC LIMIT ?"""
+SQL_BILLING_HISTORY_BEFORE = """SELECT id, invoice_id, created_at, amount, status, description 
+                                FROM billing WHERE customer_id = ?1
+                                  AND created_at <= ?2 AND (created_at < ?2 OR id < ?3)
+                                ORDER BY created_at DESC, id DESC LIMIT ?4"""
+SQL_INSERT_TICKET = """INSERT INTO tickets (customer_id, subject, message, category, ai_responded) 
+                       VALUES (?, ?, ?, ?, ?)"""
+SQL_INSERT_TICKET_RESPONSE = """INSERT INTO ticket_responses (ticket_id, from_agent, message) 
+                                VALUES (?, ?, ?)"""
+SQL_LIST_TICKETS = """SELECT id, subject, message, category, status, ai_responded, created_at 
+                      FROM tickets WHERE customer_id = ?
+                      ORDER BY id DESC LIMIT ?"""
+SQL_LIST_TICKETS_BEFORE = """SELECT id, subject, message, category, status, ai_responded, created_at 
+                             FROM tickets WHERE customer_id = ? AND id < ?
+                             ORDER BY id DESC LIMIT ?"""
+SQL_TICKET_RESPONSES = """SELECT r.from_agent, r.message, r.created_at 
+                          FROM ticket_responses r JOIN tickets t ON t.id = r.ticket_id
+                          WHERE r.ticket_id = ? AND t.customer_id = ?
+                          ORDER BY r.created_at ASC"""
+SQL_TICKET_EXISTS = "SELECT 1 FROM tickets WHERE id = ? AND customer_id = ?"
 
 # Helper functions
+class _Clock(NamedTuple):
+    second: int
+    local_iso: str       # local time, for created_at in responses
+    utc_timestamp: str   # CURRENT_TIMESTAMP format, for usage rows
+    next_midnight: str   # UTC with offset, for rate_limit_reset (the limiter's day is UTC)
+
+_CLOCK = _Clock(-1, "", "", "")
+
+def clock() -> _Clock:
+    """Current time, formatted at most once per second and shared by all requests"""
+    global _CLOCK
+    now = int(time.time())
+    current = _CLOCK
+    if current.second != now:
+        utc = datetime.fromtimestamp(now, timezone.utc)
+        midnight = datetime.combine(utc.date() + timedelta(days=1), datetime.min.time(), timezone.utc)
+        current = _CLOCK = _Clock(
+            now,
+            datetime.fromtimestamp(now).isoformat(),
+            utc.strftime("%Y-%m-%d %H:%M:%S"),
+            midnight.isoformat()
+        )
+    return current
+
 def hash_api_key(key: str) -> str:
+    # hashlib's sha256 is the OpenSSL implementation (SHA-NI where available)
     return hashlib.sha256(key.encode()).hexdigest()
 
-def verify_customer(customer_id: str = Header(..., alias="X-Customer-ID")):
+def _lookup_key_hash(key_hash: str) -> Optional[tuple]:
+    """Resolve a key hash to (customer_id, key_id, revoked), cached until the key is written"""
+    with _KEY_CACHE_LOCK:
+        if key_hash in _KEY_CACHE:
+            return _KEY_CACHE[key_hash]
+        generation = _KEY_CACHE_GENERATION
+    
+    with get_conn() as conn:
+        row = conn.execute(SQL_LOOKUP_KEY_HASH, (key_hash,)).fetchone()
+    
+    with _KEY_CACHE_LOCK:
+        if generation == _KEY_CACHE_GENERATION:
+            _KEY_CACHE[key_hash] = row
+    return row
+
+def _invalidate_key_hashes(*key_hashes: str):
+    """Drop cached lookups for keys just written (call with the writer connection held)"""
+    global _KEY_CACHE_GENERATION
+    with _KEY_CACHE_LOCK:
+        _KEY_CACHE_GENERATION += 1
+        for key_hash in key_hashes:
+            _KEY_CACHE.pop(key_hash, None)
+
+def _counter_key(customer_id: str) -> Tuple[str, str]:
+    # Keyed by UTC day, matching CURRENT_TIMESTAMP in the usage table
+    return (customer_id, clock().utc_timestamp[:10])
+
+def counted_today(key: Tuple[str, str]) -> Optional[int]:
+    """Live count from the rate limiter for a _counter_key(), if it has seen one"""
+    with _COUNTER_LOCK:
+        return _USAGE_COUNTERS.get(key)
+
+def count_usage(customer_id: str) -> int:
+    """Count one call against today's limit and return the new total (429 when exhausted)"""
+    key = _counter_key(customer_id)
+    with _COUNTER_LOCK:
+        count = _USAGE_COUNTERS.get(key)
+    
+    if count is None:
+        with get_conn() as conn:
+            count = conn.execute(SQL_USAGE_TODAY, (customer_id,)).fetchone()[0]
+    
+    with _COUNTER_LOCK:
+        if key not in _USAGE_COUNTERS:
+            # First count of a new day: drop the previous days' counters
+            for stale in [k for k in _USAGE_COUNTERS if k[1] != key[1]]:
+                del _USAGE_COUNTERS[stale]
+            _USAGE_COUNTERS[key] = count
+        if _USAGE_COUNTERS[key] >= RATE_LIMIT:
+            raise HTTPException(status_code=429, detail="Rate limit exceeded")
+        _USAGE_COUNTERS[key] += 1
+        return _USAGE_COUNTERS[key]
+
+def flush_usage():
+    """Write all buffered usage rows in a single transaction"""
+    global _USAGE_BUFFER
+    with _BUFFER_LOCK:
+        rows, _USAGE_BUFFER = _USAGE_BUFFER, []
+    if not rows:
+        return
+    
+    try:
+        with get_write_conn() as conn:
+            conn.executemany(SQL_INSERT_USAGE, rows)
+            conn.commit()
+    except Exception:
+        # Keep the rows for the next flush rather than dropping them
+        with _BUFFER_LOCK:
+            _USAGE_BUFFER[:0] = rows
+        raise
+    
+    with _CACHE_LOCK:
+        for customer_id in {row[0] for row in rows}:
+            _STATS_CACHE.pop(customer_id, None)
+
+async def flush_usage_periodically(stop: asyncio.Event):
+    """Flush the usage buffer every USAGE_FLUSH_INTERVAL until stop is set"""
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=USAGE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await run_in_threadpool(flush_usage)
+        except Exception:
+            logger.exception("Failed to flush usage buffer")
+
+# Non-blocking, so async: FastAPI would otherwise run it in the threadpool
+async def verify_customer(customer_id: str = Header(..., alias="X-Customer-ID")):
     if not customer_id:
         raise HTTPException(status_code=401, detail="Customer ID required")
     return customer_id
@@ -151,21 +469,18 @@ def create_api_key(request: APIKeyRequest):
     key = f"sk_{secrets.token_urlsafe(32)}"
     key_hash = hash_api_key(key)
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO api_keys (customer_id, key_hash, name) VALUES (?, ?, ?)",
-        (request.customer_id, key_hash, request.name)
-    )
-    conn.commit()
-    key_id = c.lastrowid
-    conn.close()
+    with get_write_conn() as conn:
+        c = conn.cursor()
+        c.execute(SQL_INSERT_API_KEY, (request.customer_id, key_hash, request.name))
+        conn.commit()
+        key_id = c.lastrowid
+        _invalidate_key_hashes(key_hash)
     
     return {
         "key_id": key_id,
         "api_key": key,
         "name": request.name,
-        "created_at": datetime.now().isoformat(),
+        "created_at": clock().local_iso,
         "warning": "Save this key - it won't be shown again"
     }
 
@@ -174,168 +489,198 @@ def rotate_api_key(request: APIKeyRotateRequest, customer_id: str = Depends(veri
     """Rotate (replace) an existing API key"""
     old_hash = hash_api_key(request.old_key)
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    
-    # Verify old key belongs to customer
-    c.execute(
-        "SELECT id FROM api_keys WHERE customer_id = ? AND key_hash = ? AND revoked = 0",
-        (customer_id, old_hash)
-    )
-    result = c.fetchone()
-    
-    if not result:
-        conn.close()
-        raise HTTPException(status_code=404, detail="API key not found")
-    
-    old_key_id = result[0]
-    
-    # Revoke old key
-    c.execute("UPDATE api_keys SET revoked = 1 WHERE id = ?", (old_key_id,))
-    
-    # Create new key
-    new_key = f"sk_{secrets.token_urlsafe(32)}"
-    new_hash = hash_api_key(new_key)
-    c.execute(
-        "INSERT INTO api_keys (customer_id, key_hash, name) VALUES (?, ?, ?)",
-        (customer_id, new_hash, "Rotated Key")
-    )
-    conn.commit()
-    new_key_id = c.lastrowid
-    conn.close()
+    with get_write_conn() as conn:
+        c = conn.cursor()
+        
+        # Revoke old key; matching no row means it isn't this customer's active key
+        c.execute(SQL_REVOKE_KEY_BY_HASH, (customer_id, old_hash))
+        if c.rowcount == 0:
+            raise HTTPException(status_code=404, detail="API key not found")
+        
+        # Create new key
+        new_key = f"sk_{secrets.token_urlsafe(32)}"
+        new_hash = hash_api_key(new_key)
+        c.execute(SQL_INSERT_API_KEY, (customer_id, new_hash, "Rotated Key"))
+        conn.commit()
+        new_key_id = c.lastrowid
+        _invalidate_key_hashes(old_hash, new_hash)
     
     return {
         "key_id": new_key_id,
         "api_key": new_key,
-        "created_at": datetime.now().isoformat(),
+        "created_at": clock().local_iso,
         "warning": "Old key has been revoked"
     }
 
 @app.get("/api/keys/list")
-def list_api_keys(customer_id: str = Depends(verify_customer)):
-    """List all API keys for customer (no actual keys shown)"""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute(
-        """SELECT id, name, created_at, last_used, revoked 
-           FROM api_keys WHERE customer_id = ?
-           ORDER BY created_at DESC""",
-        (customer_id,)
-    )
-    keys = []
-    for row in c.fetchall():
-        keys.append({
-            "key_id": row[0],
-            "name": row[1],
-            "created_at": row[2],
-            "last_used": row[3],
-            "revoked": bool(row[4])
-        })
-    conn.close()
-    return {"keys": keys}
+def list_api_keys(
+    before: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=100),
+    customer_id: str = Depends(verify_customer)
+):
+    """List API keys for customer, newest first (no actual keys shown)"""
+    if before is None:
+        query, params = SQL_LIST_API_KEYS, (customer_id, limit)
+    else:
+        query, params = SQL_LIST_API_KEYS_BEFORE, (customer_id, before, limit)
+    
+    with get_conn() as conn:
+        rows = conn.execute(query, params).fetchall()
+    keys = [
+        {
+            "key_id": row["id"],
+            "name": row["name"],
+            "created_at": row["created_at"],
+            "last_used": row["last_used"],
+            "revoked": bool(row["revoked"])
+        }
+        for row in rows
+    ]
+    next_cursor = rows[-1]["id"] if len(rows) == limit else None
+    return {"keys": keys, "next_cursor": next_cursor}
+
+@app.get("/api/keys/count")
+def count_api_keys(customer_id: str = Depends(verify_customer)):
+    """Count active API keys for customer"""
+    with get_conn() as conn:
+        active = conn.execute(SQL_COUNT_ACTIVE_KEYS, (customer_id,)).fetchone()[0]
+    return {"active": active}
 
 @app.delete("/api/keys/{key_id}")
 def revoke_api_key(key_id: int, customer_id: str = Depends(verify_customer)):
     """Revoke an API key"""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute(
-        "UPDATE api_keys SET revoked = 1 WHERE id = ? AND customer_id = ?",
-        (key_id, customer_id)
-    )
-    conn.commit()
-    conn.close()
+    with get_write_conn() as conn:
+        row = conn.execute(SQL_REVOKE_CUSTOMER_KEY, (key_id, customer_id)).fetchone()
+        conn.commit()
+        if row:
+            _invalidate_key_hashes(row["key_hash"])
     return {"message": "API key revoked"}
 
 @app.get("/api/usage/stats")
 def get_usage_stats(customer_id: str = Depends(verify_customer)) -> UsageStats:
     """Get usage statistics for customer"""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
+    key = _counter_key(customer_id)
+    with _CACHE_LOCK:
+        cached = _STATS_CACHE.get(customer_id)
     
-    # Today's usage
-    c.execute(
-        """SELECT COUNT(*) FROM usage 
-           WHERE customer_id = ? AND DATE(timestamp) = DATE('now')""",
-        (customer_id,)
-    )
-    today = c.fetchone()[0]
-    
-    # This month
-    c.execute(
-        """SELECT COUNT(*) FROM usage 
-           WHERE customer_id = ? AND strftime('%Y-%m', timestamp) = strftime('%Y-%m', 'now')""",
-        (customer_id,)
-    )
-    this_month = c.fetchone()[0]
-    
-    # All time
-    c.execute("SELECT COUNT(*) FROM usage WHERE customer_id = ?", (customer_id,))
-    all_time = c.fetchone()[0]
+    # A cached entry from before UTC midnight has yesterday's "today" and
+    # can't be patched with the new day's counter, so recompute it
+    if cached is not None and cached[0] == key[1]:
+        stats = cached[1]
+    else:
+        with get_conn() as conn:
+            today, this_month, all_time = conn.execute(SQL_USAGE_STATS, (customer_id,)).fetchone()
+        stats = UsageStats(
+            today=today,
+            this_month=this_month,
+            all_time=all_time,
+            current_rate_limit=RATE_LIMIT - today,
+            rate_limit_reset=clock().next_midnight if today > 0 else None
+        )
+        with _CACHE_LOCK:
+            _STATS_CACHE[customer_id] = (key[1], stats)
     
-    conn.close()
+    # The rate limiter's counter is ahead of the (cached, batch-flushed) table;
+    # report its figure so the dashboard agrees with what /api/usage/track enforces
+    live_today = counted_today(key)
+    if live_today is not None and live_today != stats.today:
+        unflushed = live_today - stats.today
+        stats = stats.model_copy(update={
+            "today": live_today,
+            "this_month": stats.this_month + unflushed,
+            "all_time": stats.all_time + unflushed,
+            "current_rate_limit": RATE_LIMIT - live_today,
+            "rate_limit_reset": clock().next_midnight if live_today > 0 else None,
+        })
+    return stats
+
+@app.post("/api/usage/track")
+def track_usage(request: UsageTrackRequest):
+    """Record one API call for a customer, enforcing the daily rate limit"""
+    key = _lookup_key_hash(request.api_key_hash)
+    if not key or key[0] != request.customer_id or key[2]:
+        raise HTTPException(status_code=401, detail="Invalid API key")
     
-    # Mock rate limiting (1000 requests/day for MVP)
-    rate_limit = 1000
-    reset_time = (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0)
+    today = count_usage(request.customer_id)
     
-    return UsageStats(
-        today=today,
-        this_month=this_month,
-        all_time=all_time,
-        current_rate_limit=rate_limit - today,
-        rate_limit_reset=reset_time.isoformat() if today > 0 else None
+    # Stamped now in CURRENT_TIMESTAMP's format, not when the batch is written
+    row = (
+        request.customer_id, request.api_key_hash, request.endpoint, request.success,
+        clock().utc_timestamp
     )
+    with _BUFFER_LOCK:
+        _USAGE_BUFFER.append(row)
+        full = len(_USAGE_BUFFER) >= USAGE_BUFFER_MAX
+    if full:
+        # Flusher is falling behind; write inline instead of growing unbounded.
+        # The call is already counted and its row re-queued on failure, so
+        # don't fail the request (a client retry would count it twice)
+        try:
+            flush_usage()
+        except Exception:
+            logger.exception("Failed to flush usage buffer")
+    
+    return {"today": today, "remaining": RATE_LIMIT - today}
 
 @app.get("/api/billing/history")
-def get_billing_history(customer_id: str = Depends(verify_customer)) -> List[BillingHistory]:
-    """Get billing history for last 12 months"""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute(
-        """SELECT invoice_id, created_at, amount, status, description 
-           FROM billing WHERE customer_id = ?
-           ORDER BY created_at DESC LIMIT 12""",
-        (customer_id,)
-    )
-    history = []
-    for row in c.fetchall():
-        history.append(BillingHistory(
-            invoice_id=row[0],
-            date=row[1],
-            amount=row[2],
-            status=row[3],
-            description=row[4] or "API Usage"
-        ))
-    conn.close()
-    return history
+def get_billing_history(
+    before: Optional[str] = None,
+    limit: int = Query(12, ge=1, le=100),
+    customer_id: str = Depends(verify_customer)
+) -> BillingPage:
+    """Get billing history, newest first (12 invoices per page by default)"""
+    cache_key = (customer_id, before, limit)
+    with _CACHE_LOCK:
+        cached = _BILLING_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    if before is None:
+        query, params = SQL_BILLING_HISTORY, (customer_id, limit)
+    else:
+        # Cursor is "<created_at>,<id>" of the last invoice on the previous page
+        before_date, _, before_id = before.rpartition(",")
+        if not before_date or not before_id.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query, params = SQL_BILLING_HISTORY_BEFORE, (customer_id, before_date, int(before_id), limit)
+    
+    with get_conn() as conn:
+        rows = conn.execute(query, params).fetchall()
+    invoices = [
+        BillingHistory(
+            invoice_id=row["invoice_id"],
+            date=row["created_at"],
+            amount=row["amount"],
+            status=row["status"],
+            description=row["description"] or "API Usage"
+        )
+        for row in rows
+    ]
+    next_cursor = f"{rows[-1]['created_at']},{rows[-1]['id']}" if len(rows) == limit else None
+    page = BillingPage(invoices=invoices, next_cursor=next_cursor)
+    with _CACHE_LOCK:
+        _BILLING_CACHE[cache_key] = page
+    return page
 
 @app.post("/api/tickets/create")
 def create_ticket(ticket: TicketCreate, customer_id: str = Depends(verify_customer)):
     """Create a support ticket"""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute(
-        """INSERT INTO tickets (customer_id, subject, message, category) 
-           VALUES (?, ?, ?, ?)""",
-        (customer_id, ticket.subject, ticket.message, ticket.category)
-    )
-    conn.commit()
-    ticket_id = c.lastrowid
-    
     # Auto-respond with AI (simple keyword matching for MVP)
     ai_response = generate_ai_response(ticket.subject, ticket.message, ticket.category)
-    if ai_response:
+    
+    # Ticket and AI response are written in one transaction (one fsync)
+    with get_write_conn() as conn:
+        c = conn.cursor()
         c.execute(
-            """INSERT INTO ticket_responses (ticket_id, from_agent, message) 
-               VALUES (?, ?, ?)""",
-            (ticket_id, False, ai_response)
+            SQL_INSERT_TICKET,
+            (customer_id, ticket.subject, ticket.message, ticket.category, ai_response is not None)
         )
-        c.execute("UPDATE tickets SET ai_responded = 1 WHERE id = ?", (ticket_id,))
+        ticket_id = c.lastrowid
+        
+        if ai_response:
+            c.execute(SQL_INSERT_TICKET_RESPONSE, (ticket_id, False, ai_response))
         conn.commit()
     
-    conn.close()
-    
     return {
         "ticket_id": ticket_id,
         "status": "open",
@@ -344,107 +689,116 @@ def create_ticket(ticket: TicketCreate, customer_id: str = Depends(verify_custom
     }
 
 @app.get("/api/tickets/list")
-def list_tickets(customer_id: str = Depends(verify_customer)):
-    """List all tickets for customer"""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute(
-        """SELECT id, subject, message, category, status, ai_responded, created_at 
-           FROM tickets WHERE customer_id = ?
-           ORDER BY created_at DESC""",
-        (customer_id,)
-    )
-    tickets = []
-    for row in c.fetchall():
-        tickets.append({
-            "id": row[0],
-            "subject": row[1],
-            "message": row[2],
-            "category": row[3],
-            "status": row[4],
-            "ai_responded": bool(row[5]),
-            "created_at": row[6]
-        })
-    conn.close()
-    return {"tickets": tickets}
+def list_tickets(
+    before: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=100),
+    customer_id: str = Depends(verify_customer)
+):
+    """List tickets for customer, newest first"""
+    if before is None:
+        query, params = SQL_LIST_TICKETS, (customer_id, limit)
+    else:
+        query, params = SQL_LIST_TICKETS_BEFORE, (customer_id, before, limit)
+    
+    with get_conn() as conn:
+        rows = conn.execute(query, params).fetchall()
+    tickets = [
+        {**row, "ai_responded": bool(row["ai_responded"])}
+        for row in map(dict, rows)
+    ]
+    next_cursor = rows[-1]["id"] if len(rows) == limit else None
+    return {"tickets": tickets, "next_cursor": next_cursor}
 
 @app.get("/api/tickets/{ticket_id}/responses")
 def get_ticket_responses(ticket_id: int, customer_id: str = Depends(verify_customer)):
     """Get all responses for a ticket"""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    
-    # Verify ticket belongs to customer
-    c.execute("SELECT id FROM tickets WHERE id = ? AND customer_id = ?", (ticket_id, customer_id))
-    if not c.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Ticket not found")
-    
-    c.execute(
-        """SELECT from_agent, message, created_at 
-           FROM ticket_responses WHERE ticket_id = ?
-           ORDER BY created_at ASC""",
-        (ticket_id,)
-    )
-    responses = []
-    for row in c.fetchall():
-        responses.append({
-            "from_agent": bool(row[0]),
-            "message": row[1],
-            "created_at": row[2]
-        })
-    conn.close()
+    with get_conn() as conn:
+        # Ownership is checked by the join, so the common case is one query
+        rows = conn.execute(SQL_TICKET_RESPONSES, (ticket_id, customer_id)).fetchall()
+        
+        # No responses: tell "not yours / missing" apart from "no replies yet"
+        if not rows and not conn.execute(SQL_TICKET_EXISTS, (ticket_id, customer_id)).fetchone():
+            raise HTTPException(status_code=404, detail="Ticket not found")
+    responses = [
+        {**row, "from_agent": bool(row["from_agent"])}
+        for row in map(dict, rows)
+    ]
     return {"responses": responses}
 
 # Simple AI responder (keyword matching for MVP)
+# Canned responses per keyword category
+AI_RESPONSES = {
+    # API key questions
+    "api_key": (
+        "To rotate your API key:\n"
+        "1. Go to the 'API Keys' tab\n"
+        "2. Click 'Rotate Key' next to your current key\n"
+        "3. Save the new key immediately (it won't be shown again)\n\n"
+        "Your old key will be revoked automatically."
+    ),
+    # Usage questions
+    "usage": (
+        "You can view your real-time usage statistics on the dashboard:\n"
+        "- Today's requests\n"
+        "- This month's total\n"
+        "- All-time usage\n\n"
+        "Visit the 'Usage' tab for detailed analytics."
+    ),
+    # Billing questions
+    "billing": (
+        "Your billing history is available in the 'Billing' tab. You'll find:\n"
+        "- All invoices (last 12 months)\n"
+        "- Payment status\n"
+        "- Usage breakdown\n\n"
+        "For refunds or billing disputes, please reply to this ticket and we'll prioritize it."
+    ),
+    # Rate limit questions
+    "rate_limit": (
+        "You've hit your rate limit. Check the 'Usage' tab for:\n"
+        "- Current limit remaining\n"
+        "- Reset time (usually midnight UTC)\n\n"
+        "To increase your limit, upgrade your plan or contact us for custom limits."
+    ),
+}
+
+# Checked in priority order; the first category with a hit wins
+AI_KEYWORDS = {
+    "api_key": ("api key", "reset key"),
+    "usage": ("usage", "how many", "calls"),
+    "billing": ("bill", "charge", "invoice"),
+    "rate_limit": ("rate limit", "too many requests"),
+}
+
+# Status codes must match as a whole word so "429" doesn't fire inside "14290"
+_HTTP_429 = re.compile(r"\b429\b")
+
+# Flattened once so the hot path is a plain loop of C-level substring checks
+_KEYWORD_RESPONSES = tuple(
+    (keyword, AI_RESPONSES[tag])
+    for tag, keywords in AI_KEYWORDS.items()
+    for keyword in keywords
+)
+
 def generate_ai_response(subject: str, message: str, category: str) -> Optional[str]:
     """Generate automated response based on keywords"""
     text = f"{subject} {message}".lower()
     
-    # API key questions
-    if "api key" in text or "reset key" in text:
-        return (
-            "To rotate your API key:\n"
-            "1. Go to the 'API Keys' tab\n"
-            "2. Click 'Rotate Key' next to your current key\n"
-            "3. Save the new key immediately (it won't be shown again)\n\n"
-            "Your old key will be revoked automatically."
-        )
+    for keyword, response in _KEYWORD_RESPONSES:
+        if keyword in text:
+            return response
     
-    # Usage questions
-    if "usage" in text or "how many" in text or "calls" in text:
-        return (
-            "You can view your real-time usage statistics on the dashboard:\n"
-            "- Today's requests\n"
-            "- This month's total\n"
-            "- All-time usage\n\n"
-            "Visit the 'Usage' tab for detailed analytics."
-        )
-    
-    # Billing questions
-    if "bill" in text or "charge" in text or "invoice" in text:
-        return (
-            "Your billing history is available in the 'Billing' tab. You'll find:\n"
-            "- All invoices (last 12 months)\n"
-            "- Payment status\n"
-            "- Usage breakdown\n\n"
-            "For refunds or billing disputes, please reply to this ticket and we'll prioritize it."
-        )
-    
-    # Rate limit questions
-    if "429" in text or "rate limit" in text or "too many requests" in text:
-        return (
-            "You've hit your rate limit. Check the 'Usage' tab for:\n"
-            "- Current limit remaining\n"
-            "- Reset time (usually midnight UTC)\n\n"
-            "To increase your limit, upgrade your plan or contact us for custom limits."
-        )
+    # rate_limit is the last category, so checking the code here keeps priority.
+    # The regex starts just before the first "429" (found by the fast substring
+    # search) so it doesn't rescan the rest of the text
+    first = text.find("429")
+    if first != -1 and _HTTP_429.search(text, max(first - 1, 0)):
+        return AI_RESPONSES["rate_limit"]
     
     # Can't auto-respond, escalate to human
     return None
 
 @app.get("/health")
-def health():
+async def health():
     return {"status": "ok"}
 
 if __name__ == "__main__":